@@ -1,22 +1,30 @@
 import os
+import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 import pandas as pd
 # Consolidated datetime imports to avoid confusion
 from datetime import datetime
 import datetime # Keep this for datetime.date.today() and datetime.fromisoformat
 #from dotenv import load_dotenv
-import json
 import io
-import time
+from dateutil import tz
+from concurrent.futures import ThreadPoolExecutor
 import plotly.express as px
 import altair as alt
 
 # Assuming db_helper is in the same directory and its functions are correctly defined
-from db_helper import generate_reference, save_upload_with_json, get_all_references, get_tracking_numbers, get_tracking_json
+from db_helper import generate_reference, save_uploads_bulk, get_all_references, get_tracking_numbers, get_tracking_json, get_tracking_json_batch
 
 st.set_page_config(page_title="FedEx Shipment Tracker", layout="wide")
 
+# The root logger stays at WARNING so httpx doesn't log every Supabase request;
+# only db_helper runs at INFO, which logs one line per saved batch.
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger("db_helper").setLevel(logging.INFO)
+
 # ✅ Global CSS Styling (Keeping this for general styling)
 st.markdown("""
     <style>
@@ -43,6 +51,8 @@ if 'current_page' not in st.session_state:
 #load_dotenv()
 API_ENDPOINT = "https://apis-sandbox.fedex.com/track/v1/trackingnumbers"
 AUTH_URL = "https://apis-sandbox.fedex.com/oauth/token"
+MAX_TRACKING_NUMBERS_PER_REQUEST = 30 # FedEx Track API limit per call
+MAX_CONCURRENT_REQUESTS = 10 # Parallel tracking calls during bulk upload
 #API_KEY = os.getenv("FEDEX_API_KEY")
 #API_SECRET = os.getenv("FEDEX_API_SECRET") # Ensure this matches your .env key
 
@@ -54,39 +64,142 @@ if not API_KEY or not API_SECRET:
     st.error("❌ API_KEY or API_SECRET environment variables not set.")
     st.stop()
 
-# ✅ API functions (no change needed here)
-def get_access_token():
+# ✅ API functions
+@st.cache_resource
+def get_http_session():
+    # One keep-alive session for every FedEx call, so repeated auth/tracking
+    # requests reuse the pooled TCP+TLS connections instead of reconnecting.
+    # Transient 429/5xx responses from the sandbox are retried with backoff rather than
+    # surfacing as failed shipments; raise_on_status=False hands back the last response
+    # so callers still see the status code once retries run out.
+    retry = Retry(total=5, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(['POST']), raise_on_status=False)
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(max_retries=retry, pool_connections=32, pool_maxsize=32))
+    return session
+
+# FedEx tokens are valid for ~1 hour; reuse one across reruns and sessions
+@st.cache_data(ttl=3300, show_spinner=False)
+def _cached_access_token():
     data = {
         'grant_type': 'client_credentials',
         'client_id': API_KEY,
         'client_secret': API_SECRET
     }
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    response = requests.post(AUTH_URL, data=data, headers=headers)
-    if response.status_code == 200:
-        return response.json()['access_token']
-    else:
-        st.error(f"Failed to authenticate: {response.status_code} - {response.text}")
+    response = get_http_session().post(AUTH_URL, data=data, headers=headers)
+    response.raise_for_status() # Raise rather than return None so failures are never cached
+    return response.json()['access_token']
+
+def get_access_token():
+    try:
+        return _cached_access_token()
+    except requests.HTTPError as e:
+        st.error(f"Failed to authenticate: {e.response.status_code} - {e.response.text}")
         return None
 
-def track_shipment(tracking_number, access_token):
+def refresh_access_token():
+    _cached_access_token.clear()
+    return get_access_token()
+
+def _post_tracking(tracking_numbers, access_token):
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
     payload = {
         "trackingInfo": [
-            {"trackingNumberInfo": {"trackingNumber": tracking_number}}
+            {"trackingNumberInfo": {"trackingNumber": tn}} for tn in tracking_numbers
         ],
         "includeDetailedScans": True
     }
-    response = requests.post(API_ENDPOINT, headers=headers, json=payload)
+    return get_http_session().post(API_ENDPOINT, headers=headers, json=payload)
+
+def track_shipment(tracking_number, access_token):
+    response = _post_tracking([tracking_number], access_token)
+    if response.status_code == 401: # Cached token expired or was revoked; refresh once
+        access_token = refresh_access_token()
+        if not access_token:
+            return None
+        response = _post_tracking([tracking_number], access_token)
     if response.status_code == 200:
         return response.json()
     else:
         st.error(f"Failed to track shipment: {response.status_code} - {response.text}")
         return None
 
+def track_shipments_batch(tracking_numbers, access_token):
+    # Runs on worker threads, which have no Streamlit script context, so it must
+    # not call st.*; connection errors are returned for the caller to report.
+    try:
+        return _post_tracking(tracking_numbers, access_token)
+    except requests.RequestException as e:
+        return e
+
+def _is_ok(response):
+    return isinstance(response, requests.Response) and response.status_code == 200
+
+def _failure(response):
+    # (status, text) for the script thread to show; status is None for connection errors
+    if isinstance(response, requests.Response):
+        return response.status_code, response.text
+    return None, str(response)
+
+def _fetch_batches(batches, access_token):
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as pool:
+        return list(pool.map(lambda batch: track_shipments_batch(batch, access_token), batches))
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# Returns (tracking_number, result, error) triples in input order. result has the same
+# shape as a single track_shipment() response, or is None if it could not be fetched,
+# in which case error is the (status, text) of the last failed request.
+def track_shipments_concurrently(tracking_numbers, access_token):
+    batches = list(chunks(tracking_numbers, MAX_TRACKING_NUMBERS_PER_REQUEST))
+    responses = _fetch_batches(batches, access_token)
+
+    # An expired token fails every batch with 401: refresh it once and retry those
+    expired = [i for i, r in enumerate(responses) if isinstance(r, requests.Response) and r.status_code == 401]
+    if expired:
+        access_token = refresh_access_token()
+        if access_token:
+            retried = _fetch_batches([batches[i] for i in expired], access_token)
+            for i, response in zip(expired, retried):
+                responses[i] = response
+
+    results_by_tn = {}
+    errors_by_tn = {}
+    for batch, response in zip(batches, responses):
+        if not _is_ok(response):
+            errors_by_tn.update(dict.fromkeys(batch, _failure(response)))
+            continue
+        data = response.json()
+        output = data.get('output', {})
+        for ctr in output.get('completeTrackResults', []):
+            # Re-wrap each shipment so saved rows look like single-track responses
+            results_by_tn[ctr.get('trackingNumber')] = {**data, 'output': {**output, 'completeTrackResults': [ctr]}}
+
+    # A rejected batch (e.g. a 400 for one bad number) or a number FedEx echoed back in
+    # another form leaves gaps; retry those one number per request, where the single
+    # result needs no matching and one bad number can't fail the others
+    missing = list(dict.fromkeys(tn for tn in tracking_numbers if tn not in results_by_tn))
+    if missing and access_token:
+        for tn, response in zip(missing, _fetch_batches([[tn] for tn in missing], access_token)):
+            data = response.json() if _is_ok(response) else {}
+            if data.get('output', {}).get('completeTrackResults'):
+                results_by_tn[tn] = data
+                errors_by_tn.pop(tn, None)
+            else:
+                errors_by_tn[tn] = _failure(response)
+
+    no_result = (None, "No tracking result returned")
+    return [(tn, results_by_tn.get(tn), None if tn in results_by_tn else errors_by_tn.get(tn, no_result))
+            for tn in tracking_numbers]
+
+# The template never changes, so build the workbook once per process
+@st.cache_data
 def get_sample_template():
     sample_df = pd.DataFrame({'TrackingNumber': ['123456789012', '987654321098']})
     output = io.BytesIO()
@@ -96,8 +209,180 @@ def get_sample_template():
         worksheet = writer.sheets['Template']
         left_align = workbook.add_format({'align': 'left'})
         worksheet.set_column('A:A', 25, left_align)
-    output.seek(0)
-    return output
+    return output.getvalue()
+
+# --- Tracking data helpers ---
+SCAN_LOCATION_KEYS = ['city', 'stateOrProvinceCode', 'countryCode', 'postalCode']
+SCAN_LOCATION_COLUMNS = ['scanLocation.' + key for key in SCAN_LOCATION_KEYS]
+
+def _text_column(df, name):
+    return df[name].fillna('N/A') if name in df else pd.Series('N/A', index=df.index)
+
+# FedEx timestamps carry the shipment's local UTC offset (2024-01-11T23:59:59-05:00).
+# The pages show that local wall-clock time, so strip the offset and parse the rest
+# in one call instead of converting to UTC (which would move late estimates a day).
+_UTC_OFFSET = r'(?:Z|[+-]\d{2}:\d{2})$'
+
+def local_datetimes(values):
+    text = pd.Series(values, dtype='object').astype('string').str.replace(_UTC_OFFSET, '', regex=True)
+    return pd.to_datetime(text, errors='coerce', format='ISO8601')
+
+# Flattens scanEvents in one json_normalize pass and parses/joins whole columns,
+# instead of walking each event in Python. Dates keep the event's local wall-clock time.
+def scan_events_frame(scan_events):
+    df = pd.json_normalize(scan_events)
+    if 'date' in df:
+        dates = local_datetimes(df['date'])
+    else:
+        dates = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+
+    location = pd.Series('', index=df.index)
+    for col in SCAN_LOCATION_COLUMNS:
+        if col in df:
+            part = df[col].fillna('').astype(str)
+            sep = pd.Series(', ', index=df.index).where((location != '') & (part != ''), '')
+            location = location + sep + part
+
+    return pd.DataFrame({
+        'Event Description': _text_column(df, 'eventDescription'),
+        'Date': dates,
+        'Exception Description': _text_column(df, 'exceptionDescription'),
+        'Location': location.replace('', 'N/A')
+    })
+
+# Flattening the stored responses is the hot loop on the results and analytics pages,
+# so these helpers bind dict.get as a default argument (a local lookup per call) and
+# walk the nested keys in straight-line code. 'raw_json' is already parsed JSONB.
+def _first_track_result(raw_json, _get=dict.get):
+    # Returns (completeTrackResults[0], trackResults[0]); either may be None
+    complete_results = _get(_get(raw_json, 'output') or {}, 'completeTrackResults')
+    if not complete_results:
+        return None, None
+    complete_result = complete_results[0]
+    track_results = _get(complete_result, 'trackResults')
+    return complete_result, (track_results[0] if track_results else None)
+
+_MIN_EVENT_TIME = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+# The one parser for scan event dates, used both to pick the latest event and to
+# display it; None for missing or malformed values
+def _parse_event_date(event, _get=dict.get):
+    try:
+        return datetime.datetime.fromisoformat(_get(event, 'date'))
+    except (TypeError, ValueError):
+        return None
+
+# Sort key for picking the latest scan event; naive dates are taken as UTC and
+# missing or malformed ones sort first
+def _event_time(event):
+    event_time = _parse_event_date(event)
+    if event_time is None:
+        return _MIN_EVENT_TIME
+    return event_time if event_time.tzinfo is not None else event_time.replace(tzinfo=datetime.timezone.utc)
+
+RESULT_COLUMNS = ['Tracking Number', 'Status', 'Estimated Delivery', 'Proof of Delivery', 'Latest Event', 'Event Date', 'Location']
+
+# One tuple per shipment, in RESULT_COLUMNS order. Estimated Delivery is left raw
+# (None when missing) so the caller can parse the column in a single call; Event Date
+# is already parsed to the event's local wall-clock time (None when missing).
+def flatten_for_results(entry, _get=dict.get):
+    tn = entry['tracking_number']
+    complete_result, track_info = _first_track_result(entry['raw_json'])
+    tracking_num = _get(complete_result, 'trackingNumber', tn) if complete_result is not None else tn
+    if track_info is None:
+        return tracking_num, 'N/A', None, 'N/A', 'N/A', None, 'N/A'
+
+    status = _get(_get(track_info, 'latestStatusDetail') or {}, 'statusByLocale', 'N/A')
+    est_delivery = None
+    for item in _get(track_info, 'dateAndTimes') or ():
+        if _get(item, 'type') == 'ESTIMATED_DELIVERY':
+            est_delivery = _get(item, 'dateTime')
+            break
+    pod = 'N/A'
+    for pod_item in _get(track_info, 'availableImages') or ():
+        pod_type = _get(pod_item, 'type')
+        if pod_type:
+            pod = pod_type
+            break
+
+    scan_events = _get(track_info, 'scanEvents')
+    if not scan_events:
+        return tracking_num, status, est_delivery, pod, 'N/A', None, 'N/A'
+    # Only the latest event is shown, so read it straight from its dict; building
+    # a DataFrame per shipment costs more than the whole rest of the row
+    latest_event = max(scan_events, key=_event_time)
+    scan_location = _get(latest_event, 'scanLocation') or {}
+    location = ', '.join(str(part) for part in map(scan_location.get, SCAN_LOCATION_KEYS) if part) or 'N/A'
+    # Local wall-clock time, as shown elsewhere: drop the offset without converting
+    event_time = _parse_event_date(latest_event)
+    event_date = event_time.replace(tzinfo=None) if event_time is not None else None
+    return (tracking_num, status, est_delivery, pod,
+            _get(latest_event, 'eventDescription') or 'N/A', event_date, location)
+
+# upload_time is a TIMESTAMPTZ, which arrives from the API as an ISO-8601 string.
+# Parse every batch's value in one call and keep the display string in the UI layer.
+# format='ISO8601' also copes with fractional seconds being omitted when zero.
+# Labels and upload_date use the server's local time zone, matching
+# datetime.date.today() in the date picker, so late-evening uploads don't land on
+# the next (UTC) day.
+UPLOAD_TIME_DISPLAY_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
+
+def references_frame(references):
+    refs_df = pd.DataFrame(references, columns=['reference_id', 'upload_time'])
+    refs_df['upload_ts'] = pd.to_datetime(refs_df['upload_time'], errors='coerce', utc=True, format='ISO8601')
+    upload_local = refs_df['upload_ts'].dt.tz_convert(tz.tzlocal())
+    refs_df['upload_label'] = upload_local.dt.strftime(UPLOAD_TIME_DISPLAY_FORMAT).fillna(refs_df['upload_time'])
+    refs_df['upload_date'] = upload_local.dt.date
+    return refs_df
+
+# --- Analytics helpers ---
+ANALYTICS_COLUMNS = ['Tracking Number', 'Status', 'Shipper City', 'Recipient City', 'Weight Value (LB)']
+
+# One tuple per shipment in ANALYTICS_COLUMNS order, or None if it has no track result
+def flatten_for_analytics(entry, _get=dict.get):
+    _, track_info = _first_track_result(entry['raw_json'])
+    if track_info is None:
+        return None
+
+    current_status = _get(_get(track_info, 'latestStatusDetail') or {}, 'statusByLocale', 'UNKNOWN')
+    shipper_address = _get(_get(track_info, 'shipperInformation') or {}, 'address') or {}
+    recipient_address = _get(_get(track_info, 'recipientInformation') or {}, 'address') or {}
+    weight_info = _get(_get(track_info, 'packageDetails') or {}, 'weightAndDimensions') or {}
+    package_weights = _get(weight_info, 'weight')
+    # Raw value only; build_analytics_df converts the whole column with pd.to_numeric
+    weight_value = _get(package_weights[0], 'value') if package_weights else None
+    return (entry['tracking_number'], current_status, _get(shipper_address, 'city', 'N/A'),
+            _get(recipient_address, 'city', 'N/A'), weight_value)
+
+# Single pass over the column: one mask drops both 'N/A' and blank cities before counting
+def city_counts(cities):
+    valid_cities = cities[~cities.isin(['N/A', ''])].dropna()
+    return valid_cities.value_counts().rename_axis(cities.name).reset_index(name='Count')
+
+# Bins in pandas so the chart ships WEIGHT_BINS rows to the browser instead of every
+# shipment; cached on the hashed weights so unrelated reruns reuse the result
+WEIGHT_BINS = 20
+
+@st.cache_data(show_spinner=False)
+def weight_histogram(weights):
+    counts = pd.cut(weights, bins=WEIGHT_BINS).value_counts(sort=False)
+    edges = pd.IntervalIndex(counts.index)
+    return pd.DataFrame({'Bin Start': edges.left, 'Bin End': edges.right, 'Count': counts.to_numpy()})
+
+# Keyed on reference_id plus a cheap fingerprint of the rows (the leading underscore
+# stops Streamlit hashing _rows itself), so switching between "All Uploads" and single
+# batches reuses the flattened frames instead of re-walking the raw JSON, while rows
+# added to a batch later (a save still in progress, save_upload_with_json) miss the cache.
+def rows_fingerprint(rows):
+    # Rows are only ever appended, so the count and highest id identify a batch's contents
+    return len(rows), max((row['id'] for row in rows), default=None)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def build_analytics_df(reference_id, rows_key, _rows):
+    processed_data = [row for row in map(flatten_for_analytics, _rows) if row is not None]
+    df = pd.DataFrame(processed_data, columns=ANALYTICS_COLUMNS)
+    df['Weight Value (LB)'] = pd.to_numeric(df['Weight Value (LB)'], errors='coerce')
+    return df
 
 # --- Login Page Function ---
 def login_page():
@@ -200,40 +485,9 @@ def main_app():
                             scan_events = track_info.get('scanEvents', [])
                             st.write("**Shipment History & Location Updates:**")
 
-                            display_events = []
-                            for event in scan_events:
-                                event_desc = event.get('eventDescription', 'N/A')
-                                # Renamed 'date' local variable to 'event_date_str' to avoid shadowing
-                                event_date_str = event.get('date', 'N/A')
-                                excep_desc = event.get('exceptionDescription', 'N/A')
-                                try:
-                                    # Use event_date_str here
-                                    event_date_obj = pd.to_datetime(event_date_str)
-                                except:
-                                    event_date_obj = event_date_str # Keep as string if parsing fails
-
-                                scan_loc = event.get('scanLocation', {})
-                                loc_parts = []
-                                for key in ['city', 'stateOrProvinceCode', 'countryCode', 'postalCode']:
-                                    val = scan_loc.get(key)
-                                    if val:
-                                        loc_parts.append(val)
-                                scan_location_str = ', '.join(loc_parts) if loc_parts else 'N/A'
-
-                                display_events.append({
-                                    'Event Description': event_desc,
-                                    'Date': event_date_obj, # Use the parsed/original date
-                                    'Exception Description' : excep_desc,
-                                    'Location': scan_location_str
-                                })
-
-                            if display_events:
-                                df = pd.DataFrame(display_events)
-                                try:
-                                    df = df.sort_values(by='Date', ascending=False)
-                                except:
-                                    pass
-                                st.dataframe(df)
+                            events_df = scan_events_frame(scan_events)
+                            if not events_df.empty:
+                                st.dataframe(events_df.sort_values(by='Date', ascending=False))
                             else:
                                 st.info("No shipment history or exceptions available.")
 
@@ -242,8 +496,7 @@ def main_app():
 
                         st.subheader("Full Raw JSON Response")
                         with st.expander("Show/Hide Full JSON"):
-                            pretty_json = json.dumps(result, indent=2)
-                            st.text_area("Full JSON Response", value=pretty_json, height=300)
+                            st.json(result) # Takes the dict as-is; no json.dumps pass on every lookup
 
     elif st.session_state.current_page == 'bulk':
         st.markdown("<div class='custom-title'>📂 Bulk Upload - Multiple Tracking Numbers</div>", unsafe_allow_html=True)
@@ -261,7 +514,9 @@ def main_app():
                 if 'TrackingNumber' not in df.columns:
                     st.error("Excel must have a column named 'TrackingNumber'")
                 else:
-                    tracking_numbers = df['TrackingNumber'].dropna().astype(str).tolist()
+                    # Strip stray whitespace so the numbers match what FedEx echoes back
+                    tracking_numbers = df['TrackingNumber'].dropna().astype(str).str.strip()
+                    tracking_numbers = tracking_numbers[tracking_numbers != ''].tolist()
                     reference_id = generate_reference()
                     with st.spinner("Getting access token..."):
                         access_token = get_access_token()
@@ -271,17 +526,22 @@ def main_app():
                         return
 
                     with st.spinner(f"Fetching tracking data for {len(tracking_numbers)} shipments..."):
-                        success_count = 0
-                        for tn in tracking_numbers:
-                            result = track_shipment(tn, access_token)
+                        rows_to_save = []
+                        for tn, result, error in track_shipments_concurrently(tracking_numbers, access_token):
                             if result:
-                                save_upload_with_json(reference_id, tn, result)
-                                success_count += 1
+                                rows_to_save.append((tn, result))
                             else:
-                                st.warning(f"Failed to fetch tracking info for {tn}")
-                            time.sleep(0.1)
+                                status, text = error
+                                st.error(f"Failed to track shipment {tn}: {status} - {text}")
 
-                    st.success(f"✅ Upload Successful! Reference ID: `{reference_id}`")
+                    success_count = save_uploads_bulk(reference_id, rows_to_save) if rows_to_save else 0
+
+                    if rows_to_save and success_count == len(rows_to_save):
+                        st.success(f"✅ Upload Successful! Reference ID: `{reference_id}`")
+                    elif success_count:
+                        st.warning(f"⚠️ Upload partially saved ({success_count} of {len(rows_to_save)} shipments). Reference ID: `{reference_id}`")
+                    else:
+                        st.error("❌ Upload failed: no tracking info was saved.")
                     st.write(f"Tracking info saved for {success_count} shipments.")
                     st.dataframe(pd.DataFrame({'Tracking Numbers': tracking_numbers}))
 
@@ -306,23 +566,17 @@ def main_app():
         )
 
         # 3. Filter the references based on the selected_date
-        filtered_references = []
-        for r in all_references_from_db:
-            try:
-                # 'upload_time' exists in the 'references_data' table, so this is correct here
-                #ref_upload_date = datetime.fromisoformat(r['upload_time']).date()
-                ref_upload_date = datetime.datetime.fromisoformat(r['upload_time']).date()
-                if ref_upload_date == selected_date:
-                    filtered_references.append(r)
-            except ValueError:
-                st.warning(f"Could not parse upload time for reference {r.get('reference_id', 'N/A')}. Skipping date filter for this reference.")
+        refs_df = references_frame(all_references_from_db)
+        for ref_id in refs_df.loc[refs_df['upload_ts'].isna(), 'reference_id']:
+            st.warning(f"Could not parse upload time for reference {ref_id}. Skipping date filter for this reference.")
+        filtered_references = refs_df[refs_df['upload_date'] == selected_date].to_dict('records')
 
         if not filtered_references:
             st.info(f"No bulk uploads found for `{selected_date.strftime('%Y-%m-%d')}`.")
             return # Exit if no batches match the date filter
 
         # 4. Prepare options for the selectbox from the filtered references
-        ref_options = {f"{r['reference_id']} (Uploaded: {r['upload_time']})": r['reference_id'] for r in filtered_references}
+        ref_options = {f"{r['reference_id']} (Uploaded: {r['upload_label']})": r['reference_id'] for r in filtered_references}
 
         # Ensure selected_ref_id is valid for the currently filtered options
         if 'selected_ref_id' not in st.session_state or st.session_state.selected_ref_id not in ref_options.values():
@@ -351,103 +605,14 @@ def main_app():
                 st.warning(f"No tracking data found for Reference ID `{st.session_state.selected_ref_id}`.")
                 return
 
-            all_results = []
-            def event_date(ev):
-                try:
-                    dt = pd.to_datetime(ev.get('date', ''))
-                    if dt.tzinfo is not None:
-                        dt = dt.tz_localize(None)
-                    return dt
-                except:
-                    return pd.Timestamp.min
-
-            for entry in all_saved_data_for_ref:
-                tn = entry['tracking_number']
-                raw_json = entry['raw_json'] # This is correct: raw_json is a dict/list
-
-                complete_results = raw_json.get('output', {}).get('completeTrackResults', [])
-                if complete_results:
-                    tracking_num = complete_results[0].get('trackingNumber', tn)
-                    track_results = complete_results[0].get('trackResults', [])
-                    if track_results:
-                        track_info = track_results[0]
-                        status = track_info.get('latestStatusDetail', {}).get('statusByLocale', 'N/A')
-                        est_delivery = 'N/A'
-                        date_times_list = track_info.get('dateAndTimes', []) # Renamed to avoid shadowing
-                        for item in date_times_list:
-                            if item.get('type') == 'ESTIMATED_DELIVERY':
-                                est_delivery = item.get('dateTime', 'N/A')
-                                try:
-                                    dt_est = pd.to_datetime(est_delivery)
-                                    if dt_est.tzinfo is not None:
-                                        dt_est = dt_est.tz_localize(None)
-                                    est_delivery = dt_est
-                                except:
-                                    pass
-                                break
-                        pod = 'N/A'
-                        pod_list = track_info.get('availableImages', [])
-                        for pod_item in pod_list:
-                            pod_type = pod_item.get('type', '')
-                            if pod_type:
-                                pod = pod_type
-                                break
-
-                        scan_events = track_info.get('scanEvents', [])
-                        if scan_events:
-                            latest_event = max(scan_events, key=event_date)
-                            event_desc = latest_event.get('eventDescription', 'N/A')
-                            event_date_val = latest_event.get('date', 'N/A')
-                            try:
-                                dt_val = pd.to_datetime(event_date_val)
-                                if dt_val.tzinfo is not None:
-                                    dt_val = dt_val.tz_localize(None)
-                                event_date_val = dt_val
-                            except:
-                                pass
-                            scan_loc = latest_event.get('scanLocation', {})
-                            loc_parts = []
-                            for key in ['city', 'stateOrProvinceCode', 'countryCode', 'postalCode']:
-                                val = scan_loc.get(key)
-                                if val:
-                                    loc_parts.append(val)
-                            scan_location_str = ', '.join(loc_parts) if loc_parts else 'N/A'
-                        else:
-                            event_desc = 'N/A'
-                            event_date_val = 'N/A'
-                            scan_location_str = 'N/A'
-                    else:
-                        status = 'N/A'
-                        est_delivery = 'N/A'
-                        pod = 'N/A'
-                        event_desc = 'N/A'
-                        event_date_val = 'N/A'
-                        scan_location_str = 'N/A'
-                else:
-                    tracking_num = tn
-                    status = 'N/A'
-                    est_delivery = 'N/A'
-                    pod = 'N/A'
-                    event_desc = 'N/A'
-                    event_date_val = 'N/A'
-                    scan_location_str = 'N/A'
-
-                all_results.append({
-                    'Tracking Number': tracking_num,
-                    'Status': status,
-                    'Estimated Delivery': est_delivery,
-                    'Proof of Delivery': pod,
-                    'Latest Event': event_desc,
-                    'Event Date': event_date_val,
-                    'Location': scan_location_str
-                })
+            # Transpose the per-shipment tuples into columns so the frame is built column-wise
+            result_columns = zip(*map(flatten_for_results, all_saved_data_for_ref))
+            result_df = pd.DataFrame(dict(zip(RESULT_COLUMNS, result_columns)))
+            result_df['Estimated Delivery'] = local_datetimes(result_df['Estimated Delivery'])
+            result_df['Event Date'] = pd.to_datetime(result_df['Event Date'])
 
             st.success("Results Fetched Successfully!")
-            result_df = pd.DataFrame(all_results)
-            try:
-                result_df = result_df.sort_values(by='Event Date', ascending=False)
-            except Exception:
-                pass
+            result_df = result_df.sort_values(by='Event Date', ascending=False)
             st.dataframe(result_df)
             csv = result_df.to_csv(index=False).encode('utf-8')
             st.download_button("Download Results as CSV", data=csv, file_name=f"{st.session_state.selected_ref_id}_{selected_date.strftime('%Y-%m-%d')}_results.csv", mime='text/csv')
@@ -463,7 +628,8 @@ def main_app():
             return
 
         reference_options_for_analytics = {"All Uploads": "all_uploads"}
-        reference_options_for_analytics.update({f"{r['reference_id']} (Uploaded: {r['upload_time']})": r['reference_id'] for r in references})
+        reference_options_for_analytics.update({f"{r['reference_id']} (Uploaded: {r['upload_label']})": r['reference_id']
+                                                for r in references_frame(references).to_dict('records')})
 
         selected_analytics_ref_key = st.selectbox(
             "Select Bulk Upload(s) for Analysis:",
@@ -472,65 +638,38 @@ def main_app():
         )
         selected_analytics_ref_id = reference_options_for_analytics[selected_analytics_ref_key]
 
-        all_raw_tracking_data = []
-
+        analytics_frames = []
         if selected_analytics_ref_id == "all_uploads":
             with st.spinner("Fetching all tracking data for analysis..."):
-                for ref_item in references:
-                    all_raw_tracking_data.extend(get_tracking_json(ref_item['reference_id']))
+                # One query for every batch, split per reference so each
+                # batch's flattened frame is still cached independently
+                for ref_id, ref_rows in get_tracking_json_batch().items():
+                    analytics_frames.append(build_analytics_df(ref_id, rows_fingerprint(ref_rows), ref_rows))
         else:
             with st.spinner(f"Fetching tracking data for {selected_analytics_ref_id}..."):
-                all_raw_tracking_data = get_tracking_json(selected_analytics_ref_id)
+                ref_rows = get_tracking_json(selected_analytics_ref_id)
+                if ref_rows:
+                    analytics_frames.append(build_analytics_df(selected_analytics_ref_id, rows_fingerprint(ref_rows), ref_rows))
 
-        if not all_raw_tracking_data:
+        if not analytics_frames:
             st.info("No tracking data available for the selected range to generate analytics.")
             return
 
-        processed_data = []
-        for entry in all_raw_tracking_data:
-            tn = entry['tracking_number']
-            # REMOVED: raw_json = json.loads(entry['raw_json'])
-            # The 'raw_json' column from Supabase is already parsed JSONB (Python dict/list)
-            raw_json = entry['raw_json']
-
-            complete_results = raw_json.get('output', {}).get('completeTrackResults', [])
-            if complete_results:
-                track_results = complete_results[0].get('trackResults', [])
-                if track_results:
-                    track_info = track_results[0]
-                    current_status = track_info.get('latestStatusDetail', {}).get('statusByLocale', 'UNKNOWN')
-                    shipper_city = track_info.get('shipperInformation', {}).get('address', {}).get('city', 'N/A')
-                    recipient_city = track_info.get('recipientInformation', {}).get('address', {}).get('city', 'N/A')
-                    weight_value = 'N/A'
-                    package_weights = track_info.get('packageDetails', {}).get('weightAndDimensions', {}).get('weight', [])
-                    if package_weights:
-                        try:
-                            weight_value = float(package_weights[0].get('value', 'N/A'))
-                        except (ValueError, TypeError):
-                            weight_value = 'N/A'
-                    processed_data.append({
-                        'Tracking Number': tn,
-                        'Status': current_status,
-                        'Shipper City': shipper_city,
-                        'Recipient City': recipient_city,
-                        'Weight Value': weight_value,
-                        'Weight Value (LB)': weight_value
-                    })
-
-        if not processed_data:
+        df_analytics = pd.concat(analytics_frames, ignore_index=True)
+        if df_analytics.empty:
             st.info("No detailed tracking data could be processed for analytics.")
             return
 
-        df_analytics = pd.DataFrame(processed_data)
-        df_analytics['Weight Value (LB)'] = pd.to_numeric(df_analytics['Weight Value (LB)'], errors='coerce')
-
         st.markdown("---")
         st.subheader("Key Performance Indicators")
         col1, col2, col3, col4 = st.columns(4)
         total_shipments = len(df_analytics)
-        delivered_shipments = df_analytics[df_analytics['Status'] == 'Delivered'].shape[0]
-        in_transit_shipments = df_analytics[(df_analytics['Status'] != 'Delivered') & (~df_analytics['Status'].str.contains('exception', case=False, na=False))].shape[0]
-        exception_shipments = df_analytics[df_analytics['Status'].str.contains('exception', case=False, na=False)].shape[0]
+        # Classify each status once and reuse the masks for all three counts
+        is_delivered = df_analytics['Status'].eq('Delivered')
+        is_exception = df_analytics['Status'].str.lower().str.contains('exception', regex=False, na=False)
+        delivered_shipments = int(is_delivered.sum())
+        in_transit_shipments = int((~is_delivered & ~is_exception).sum())
+        exception_shipments = int(is_exception.sum())
 
         with col1:
             st.metric("Total Shipments", total_shipments)
@@ -546,11 +685,8 @@ def main_app():
 
         with col_shipper:
             st.subheader("Shipments by Shipper City")
-            valid_shipper_cities = df_analytics[df_analytics['Shipper City'] != 'N/A']
-            valid_shipper_cities = valid_shipper_cities[valid_shipper_cities['Shipper City'] != '']
-            if not valid_shipper_cities.empty:
-                shipper_city_counts = valid_shipper_cities['Shipper City'].value_counts().reset_index()
-                shipper_city_counts.columns = ['Shipper City', 'Count']
+            shipper_city_counts = city_counts(df_analytics['Shipper City'])
+            if not shipper_city_counts.empty:
                 base_shipper = alt.Chart(shipper_city_counts).encode(theta=alt.Theta("Count", stack=True))
                 pie_shipper = base_shipper.mark_arc(outerRadius=120).encode(
                     color=alt.Color("Shipper City"), order=alt.Order("Count", sort="descending"),
@@ -567,11 +703,8 @@ def main_app():
 
         with col_recipient:
             st.subheader("Shipments by Recipient City")
-            valid_recipient_cities = df_analytics[df_analytics['Recipient City'] != 'N/A']
-            valid_recipient_cities = valid_recipient_cities[valid_recipient_cities['Recipient City'] != '']
-            if not valid_recipient_cities.empty:
-                recipient_city_counts = valid_recipient_cities['Recipient City'].value_counts().reset_index()
-                recipient_city_counts.columns = ['Recipient City', 'Count']
+            recipient_city_counts = city_counts(df_analytics['Recipient City'])
+            if not recipient_city_counts.empty:
                 base_recipient = alt.Chart(recipient_city_counts).encode(theta=alt.Theta("Count", stack=True))
                 pie_recipient = base_recipient.mark_arc(outerRadius=120).encode(
                     color=alt.Color("Recipient City"), order=alt.Order("Count", sort="descending"),
@@ -588,12 +721,15 @@ def main_app():
 
         st.markdown("---")
         st.subheader("Distribution of Shipment Weights")
-        valid_weights = df_analytics.dropna(subset=['Weight Value (LB)'])
+        valid_weights = df_analytics['Weight Value (LB)'].dropna()
         if not valid_weights.empty:
-            chart_weights = alt.Chart(valid_weights).mark_bar().encode(
-                alt.X('Weight Value (LB)', bin=alt.Bin(maxbins=20), title='Weight (LB)'),
-                alt.Y('count()', title='Number of Shipments'),
-                tooltip=[alt.Tooltip('Weight Value (LB)', bin=True, title='Weight Range'), 'count()']
+            weight_bins = weight_histogram(valid_weights)
+            chart_weights = alt.Chart(weight_bins).mark_bar().encode(
+                alt.X('Bin Start:Q', bin='binned', title='Weight (LB)'),
+                alt.X2('Bin End:Q'),
+                alt.Y('Count:Q', title='Number of Shipments'),
+                tooltip=[alt.Tooltip('Bin Start:Q', title='From (LB)', format='.2f'),
+                         alt.Tooltip('Bin End:Q', title='To (LB)', format='.2f'), 'Count:Q']
             ).properties(
                 title='Distribution of Shipment Weights'
             )
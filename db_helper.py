@@ -1,101 +1,44 @@
-import os
 import json
+import logging
 from datetime import datetime, date
 import random
 import string
-#from dotenv import load_dotenv # <--- ADD THIS IMPORT
 from supabase import create_client, Client
 import streamlit as st # Only needed for st.cache_resource, etc.
 
-# --- Step 1: Explicitly load environment variables at the very top ---
-# This ensures that if db_helper.py is imported or run directly,
-# it has access to the environment variables.
-# Specify the absolute path to your .env.txt file for robustness.
-env_file_path = "C:\\Users\\rcmsbot\\Documents\\FedEx Shipment Tracker\\.env.txt"
-
-print(f"DEBUG: Attempting to load .env from: {env_file_path}")
-if os.path.exists(env_file_path):
-    load_dotenv(dotenv_path=env_file_path)
-    print(f"DEBUG: Successfully called load_dotenv for {env_file_path}")
-else:
-    print(f"ERROR: .env file NOT FOUND at: {env_file_path}. Please check the path.")
-    # Exit or raise an error immediately if the .env is critical and not found
-    # import sys
-    # sys.exit("Missing .env file. Exiting.")
-
-
-# --- Step 2: Retrieve environment variables and print their status ---
-# Ensure these variables are read AFTER load_dotenv()
-'''
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
-SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
-FEDEX_API_KEY = os.getenv("FEDEX_API_KEY")
-FEDEX_API_SECRET = os.getenv("FEDEX_API_SECRET")
-'''
+log = logging.getLogger(__name__)
 
+# --- Configuration ---
+# Read from Streamlit secrets (.streamlit/secrets.toml locally, app settings when deployed)
 SUPABASE_URL = st.secrets["SUPABASE_URL"]
 SUPABASE_ANON_KEY = st.secrets["SUPABASE_ANON_KEY"]
-SUPABASE_SERVICE_KEY = st.secrets["SUPABASE_SERVICE_KEY"]
 FEDEX_API_KEY = st.secrets["FEDEX_API_KEY"]
 FEDEX_API_SECRET = st.secrets["FEDEX_API_SECRET"]
 
 
-
-print(f"DEBUG (db_helper): SUPABASE_URL = {'(set)' if SUPABASE_URL else '(None)'}")
-print(f"DEBUG (db_helper): SUPABASE_ANON_KEY = {'(set)' if SUPABASE_ANON_KEY else '(None)'}")
-print(f"DEBUG (db_helper): SUPABASE_SERVICE_KEY = {'(set)' if SUPABASE_SERVICE_KEY else '(None)'}") # THIS IS THE CRITICAL ONE
-print(f"DEBUG (db_helper): FEDEX_API_KEY = {'(set)' if FEDEX_API_KEY else '(None)'}")
-print(f"DEBUG (db_helper): FEDEX_API_SECRET = {'(set)' if FEDEX_API_SECRET else '(None)'}")
-
-
 # --- Supabase Client Initialization ---
+# Cached once per process: every helper below goes through this one client, whose
+# PostgREST HTTP session keeps its connections to Supabase alive between calls.
+# Don't create clients per call; that pays a fresh TCP+TLS handshake each time.
 @st.cache_resource
 def get_supabase_client():
     if not SUPABASE_URL:
-        st.error("Supabase URL is not set. Please configure SUPABASE_URL in your .env.txt.")
+        st.error("Supabase URL is not set. Please configure SUPABASE_URL in your Streamlit secrets.")
         raise ValueError("Supabase URL missing.")
     if not SUPABASE_ANON_KEY:
-        st.error("Supabase ANON Key is not set. Please configure SUPABASE_ANON_KEY in your .env.txt.")
+        st.error("Supabase ANON Key is not set. Please configure SUPABASE_ANON_KEY in your Streamlit secrets.")
         raise ValueError("Supabase ANON Key missing.")
     
     try:
-        print("DEBUG: Initializing Supabase client with ANON_KEY...") # Debugging
         return create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
     except Exception as e:
         st.error(f"Error initializing Supabase client with ANON key: {e}")
-        print(f"ERROR: Supabase ANON client initialization failed: {e}")
         raise
 
 supabase: Client = get_supabase_client()
 
-
-# --- Database Initialization Function ---
-def init_db():
-    print("DEBUG: Entering init_db function.")
-    print(f"DEBUG (init_db): SUPABASE_URL = {'(set)' if SUPABASE_URL else '(None)'}")
-    print(f"DEBUG (init_db): SUPABASE_SERVICE_KEY = {'(set)' if SUPABASE_SERVICE_KEY else '(None)'}") # AGAIN, CRITICAL
-
-    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
-        error_msg = "Supabase URL or SERVICE Key is not set for database initialization. Please configure SUPABASE_URL and SUPABASE_SERVICE_KEY in your .env.txt."
-        st.error(error_msg)
-        print(f"ERROR: {error_msg}")
-        raise ValueError("Supabase SERVICE_KEY credentials missing for init_db.")
-
-    try:
-        # Create a client with the SERVICE_KEY for admin tasks
-        print("DEBUG: Attempting to create admin_supabase client...")
-        admin_supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY) # <--- THIS IS THE LINE THAT IS FAILING
-        print("DEBUG: admin_supabase client created successfully.")
-        
-        # ... (rest of your init_db function remains the same, assuming tables are pre-created or handled)
-        print("Database initialization check (tables assumed to exist).")
-
-    except Exception as e:
-        error_msg = f"Error during database initialization (init_db): {e}"
-        print(f"ERROR: {error_msg}")
-        st.error(f"Failed to initialize database tables: {e}. Ensure Supabase SERVICE_KEY is correct and tables are created.")
-        raise # Re-raise to halt execution if DB init fails
+# Tables, indexes and the save_tracking function come from schema.sql (run once in
+# the Supabase SQL editor), so there is no admin client or init step at runtime.
 
 # --- Utility Functions (unchanged from your code, keeping for completeness) ---
 
@@ -105,85 +48,158 @@ def generate_reference():
     return f"REF-{timestamp}-{random_str}"
 
 
-
-# (Keep all your existing code above this function, including load_dotenv,
-# SUPABASE_URL, etc., and the @st.cache_resource get_supabase_client, and init_db)
+# Tracking rows per save_tracking call. Each call is already one set-based
+# INSERT ... SELECT on the server; COPY isn't reachable through PostgREST, so larger
+# uploads scale by sending fewer, bigger pages rather than by a separate COPY path.
+INSERT_PAGE_SIZE = 500
 
 def save_upload_with_json(reference_id, tracking_number, raw_json_data):
+    return save_uploads_bulk(reference_id, [(tracking_number, raw_json_data)]) == 1
+
+# Saves a whole batch through the save_tracking SQL function (see schema.sql), which
+# upserts the 'references_data' row and inserts the page's 'tracking_datanew' rows
+# server-side in one transaction: one round-trip per INSERT_PAGE_SIZE rows instead of
+# two per tracking number. rows is a list of (tracking_number, raw_json) pairs.
+# Returns how many rows were saved. Each page commits on its own, so when a later page
+# fails the earlier ones stay saved: they are counted, and the read caches are cleared
+# either way so those rows show up on the next read.
+def save_uploads_bulk(reference_id, rows):
+    saved = 0
     try:
-        # Use upsert() for the 'references' table
-        reference_data, count = supabase.table('references_data').upsert({
-            "reference_id": reference_id,
-            "upload_time": datetime.now().isoformat()
-        }, on_conflict='reference_id').execute()
-
-        # --- REVISED DEBUGGING BLOCK FOR JSON DATA ---
-        print(f"\n--- DEBUGGING JSON FOR TRACKING: {tracking_number} ---")
-        print(f"DEBUG: Type of 'raw_json_data' received by save_upload_with_json: {type(raw_json_data)}")
-        print(f"DEBUG: Content of 'raw_json_data' (truncated if long): {str(raw_json_data)[:500]}...")
-
-        json_to_save = raw_json_data # <--- THIS IS THE KEY CHANGE!
-
-        # Optional: Add a check for type, though Supabase client is usually robust
-        if not isinstance(json_to_save, (dict, list, type(None))):
-            print(f"WARNING: 'json_to_save' is not a dict, list, or None. Type: {type(json_to_save)}")
-            st.warning(f"Unexpected data type for JSON column: {type(json_to_save)}. Attempting to save.")
-
-        print(f"DEBUG: Final object to be saved as JSONB. Type: {type(json_to_save)}")
-        # --- END DEBUGGING BLOCK ---
-
-        # Then insert into 'tracking_datanew'
-        data, count = supabase.table('tracking_datanew').insert({
-            "reference_id": reference_id,
-            "tracking_number": tracking_number,
-            "raw_json": json_to_save # Pass the dict/list directly
-        }).execute()
-        
-        print(f"DEBUG: Data successfully inserted for tracking number: {tracking_number}")
-        return True
+        items = []
+        for tracking_number, raw_json_data in rows:
+            # Optional: Add a check for type, though Supabase client is usually robust
+            if not isinstance(raw_json_data, (dict, list, type(None))):
+                log.warning("'raw_json_data' is not a dict, list, or None. Type: %s", type(raw_json_data))
+                st.warning(f"Unexpected data type for JSON column: {type(raw_json_data)}. Attempting to save.")
+            items.append({"tn": tracking_number, "json": raw_json_data}) # Pass the dict/list directly
+
+        for start in range(0, len(items), INSERT_PAGE_SIZE):
+            page = items[start:start + INSERT_PAGE_SIZE]
+            supabase.rpc('save_tracking', {
+                "p_ref": reference_id,
+                "p_items": page
+            }).execute()
+            saved += len(page)
+
+        log.info("Saved %d tracking rows for %s", saved, reference_id)
     except Exception as e:
-        error_message = f"Error saving tracking data for {tracking_number}: {e}"
-        st.error(error_message)
-        print(f"ERROR (save_upload_with_json): {error_message}")
-        import traceback
-        traceback.print_exc() # Print full traceback for this specific error
-        return False
-
-# (Keep the rest of your db_helper.py, including get_all_references, get_tracking_numbers, etc.,
-# and the final init_db() call)
-
+        # Once per batch, not per row; the traceback goes to the log, not stdout
+        log.exception("Error saving tracking data for %s after %d rows", reference_id, saved)
+        st.error(f"Error saving tracking data for {reference_id}: {e}")
+    finally:
+        if saved:
+            clear_cached_reads()
+    return saved
+
+
+READ_PAGE_SIZE = 500 # Rows per request; must not exceed the project's PostgREST max-rows (1000 by default)
+
+# PostgREST silently truncates a response at max-rows, so large batches are read in
+# ordered .range() pages until a short page comes back. Each response stays bounded
+# in size (raw_json payloads included) no matter how many shipments a batch holds.
+# build_query must return a fresh query each time, ordered on a unique key.
+# Only used for references_data, which holds one small row per batch.
+def _select_paged(build_query):
+    rows = []
+    start = 0
+    while True:
+        page = build_query().range(start, start + READ_PAGE_SIZE - 1).execute().data
+        rows.extend(page)
+        if len(page) < READ_PAGE_SIZE:
+            return rows
+        start += READ_PAGE_SIZE
+
+# tracking_datanew is paged by keyset on its identity column instead: each page is
+# id > last id ORDER BY id LIMIT n, so it starts where the previous one stopped
+# rather than re-scanning an OFFSET's worth of rows, and the unique id means no row
+# is skipped or repeated even when a batch holds the same tracking number twice.
+# build_query returns a fresh, filtered query whose selected columns include 'id'.
+def _select_keyset(build_query):
+    rows = []
+    last_id = 0 # identity values start at 1
+    while True:
+        page = build_query().gt('id', last_id).order('id').limit(READ_PAGE_SIZE).execute().data
+        rows.extend(page)
+        if len(page) < READ_PAGE_SIZE:
+            return rows
+        last_id = page[-1]['id']
+
+# Streamlit reruns the whole script on every interaction, so reads are memoized
+# briefly. The cached helpers raise on failure so errors are never cached.
+# Plans are already reused across calls: PostgREST runs its generated SQL as
+# prepared statements (db-prepared-statements, on by default), and each reader
+# keeps one query shape, with only values like reference_id or the page range changing.
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_all_references():
+    return _select_paged(lambda: supabase.table('references_data').select('reference_id,upload_time')
+                         .order('upload_time', desc=True).order('reference_id'))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_tracking_numbers(reference_id):
+    rows = _select_keyset(lambda: supabase.table('tracking_datanew').select('id,tracking_number')
+                          .eq('reference_id', reference_id))
+    return sorted(item['tracking_number'] for item in rows)
+
+# Only the columns the pages read (plus the paging key); avoids pulling any other
+# columns with each payload
+TRACKING_JSON_COLUMNS = 'id,reference_id,tracking_number,raw_json'
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_tracking_json(reference_id):
+    return _select_keyset(lambda: supabase.table('tracking_datanew').select(TRACKING_JSON_COLUMNS)
+                          .eq('reference_id', reference_id))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_all_tracking_json(reference_ids):
+    def build_query():
+        query = supabase.table('tracking_datanew').select(TRACKING_JSON_COLUMNS)
+        if reference_ids is not None:
+            query = query.in_('reference_id', list(reference_ids))
+        return query
+    return _select_keyset(build_query)
+
+def clear_cached_reads():
+    # Called after every successful write so the next read sees the new upload
+    _fetch_all_references.clear()
+    _fetch_tracking_numbers.clear()
+    _fetch_tracking_json.clear()
+    _fetch_all_tracking_json.clear()
 
 def get_all_references():
     try:
-        response = supabase.table('references_data').select('*').order('upload_time', desc=True).execute()
-        return response.data
+        return _fetch_all_references()
     except Exception as e:
         st.error(f"Error fetching references: {e}")
         return []
 
 def get_tracking_numbers(reference_id):
     try:
-        response = supabase.table('tracking_datanew').select('tracking_number').eq('reference_id', reference_id).execute()
-        return [item['tracking_number'] for item in response.data]
+        return _fetch_tracking_numbers(reference_id)
     except Exception as e:
         st.error(f"Error fetching tracking numbers for {reference_id}: {e}")
         return []
 
 def get_tracking_json(reference_id):
     try:
-        response = supabase.table('tracking_datanew').select('*').eq('reference_id', reference_id).execute()
-        return response.data
+        return _fetch_tracking_json(reference_id)
     except Exception as e:
         st.error(f"Error fetching tracking JSON for {reference_id}: {e}")
         return []
 
-# --- Initializing the database tables on app start ---
-try:
-    print("DEBUG: Calling init_db() at the end of db_helper.py.")
-    init_db()
-except Exception as e:
-    fatal_error_msg = f"FATAL ERROR: Database initialization failed. Please check your Supabase keys and table setup. Details: {e}"
-    st.error(fatal_error_msg)
-    print(f"ERROR: {fatal_error_msg}")
-    import sys
-    sys.exit(1) # Exit if critical initialization fails
\ No newline at end of file
+# One query for several batches (all of them when reference_ids is None),
+# instead of calling get_tracking_json once per reference
+def get_all_tracking_json(reference_ids=None):
+    try:
+        return _fetch_all_tracking_json(tuple(reference_ids) if reference_ids is not None else None)
+    except Exception as e:
+        st.error(f"Error fetching tracking JSON: {e}")
+        return []
+
+# Same single query, bucketed into {reference_id: [rows]} in one pass. Every requested
+# reference gets a key, with an empty list if it has no tracking rows.
+def get_tracking_json_batch(reference_ids=None):
+    rows_by_ref = {ref_id: [] for ref_id in reference_ids} if reference_ids is not None else {}
+    for row in get_all_tracking_json(reference_ids):
+        rows_by_ref.setdefault(row['reference_id'], []).append(row)
+    return rows_by_ref
\ No newline at end of file
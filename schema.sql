@@ -0,0 +1,70 @@
+-- Supabase schema for the FedEx Shipment Tracker.
+-- Run in the Supabase SQL editor; db_helper.py assumes these objects exist.
+
+CREATE TABLE IF NOT EXISTS references_data (
+    reference_id TEXT PRIMARY KEY,
+    -- A real timestamp, not ISO text: 8 bytes, compared and sorted natively
+    upload_time  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Existing deployments that created upload_time as TEXT (values written by
+-- datetime.now().isoformat(), read here in the session time zone):
+-- ALTER TABLE references_data ALTER COLUMN upload_time TYPE TIMESTAMPTZ USING upload_time::timestamptz;
+
+CREATE TABLE IF NOT EXISTS tracking_datanew (
+    id              BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    reference_id    TEXT NOT NULL REFERENCES references_data (reference_id),
+    tracking_number TEXT NOT NULL,
+    -- JSONB, not TEXT: the client sends the parsed dict, Postgres stores the
+    -- decomposed binary form, and reads never re-parse a JSON string.
+    raw_json        JSONB NOT NULL
+);
+
+-- Existing deployments that created raw_json as TEXT:
+-- ALTER TABLE tracking_datanew ALTER COLUMN raw_json TYPE JSONB USING raw_json::jsonb;
+
+-- Serves containment queries on the payload (raw_json @> '{...}').
+-- On a large live table, run it on its own as CREATE INDEX CONCURRENTLY
+-- (CONCURRENTLY cannot run inside the editor's transaction).
+CREATE INDEX IF NOT EXISTS idx_tracking_raw_json ON tracking_datanew USING GIN (raw_json jsonb_path_ops);
+
+-- Postgres does not index foreign-key columns automatically. Every read filters
+-- tracking_datanew by reference_id, so without this each lookup is a Seq Scan.
+-- id is the second key column: reads page by keyset (id > last id ORDER BY id),
+-- so each page is an index range scan that starts where the last one stopped,
+-- with no Sort node.
+-- raw_json is deliberately not included: btree entries are capped at ~2.7 KB,
+-- which a full FedEx payload easily exceeds.
+--
+-- tracking_datanew is intentionally not range-partitioned by time: every query
+-- selects by reference_id, so time partitions would never be pruned and each
+-- lookup would probe one index per partition. This index keeps a batch lookup at
+-- O(log N) however much history accumulates. Revisit only if queries start
+-- filtering on a time range.
+CREATE INDEX IF NOT EXISTS idx_tracking_data_ref_id ON tracking_datanew (reference_id, id);
+
+ANALYZE tracking_datanew;
+
+-- get_all_references lists batches newest first straight from references_data
+-- (one row per batch); this makes the ORDER BY an index scan with no Sort node.
+CREATE INDEX IF NOT EXISTS idx_references_upload_time ON references_data (upload_time DESC);
+
+-- Called by db_helper.save_uploads_bulk via supabase.rpc(): registers the batch
+-- (keeping its first upload_time) and inserts the given tracking rows in one
+-- round-trip and one transaction. p_items is [{"tn": ..., "json": {...}}, ...].
+-- Uploads are sent in pages of INSERT_PAGE_SIZE rows, one call (and so one
+-- transaction) per page, so a large upload that fails part-way keeps its earlier pages.
+CREATE OR REPLACE FUNCTION save_tracking(p_ref TEXT, p_items JSONB)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO references_data (reference_id, upload_time)
+    VALUES (p_ref, now())
+    ON CONFLICT (reference_id) DO NOTHING;
+
+    INSERT INTO tracking_datanew (reference_id, tracking_number, raw_json)
+    SELECT p_ref, item->>'tn', item->'json'
+    FROM jsonb_array_elements(p_items) AS item;
+END;
+$$;